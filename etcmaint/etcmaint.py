@@ -4,13 +4,14 @@
 import sys
 import os
 import io
+import errno
 import stat
+import time
 import argparse
-import pathlib
-import inspect
 import re
 import hashlib
 import itertools
+import functools
 import shutil
 import contextlib
 import subprocess
@@ -20,6 +21,11 @@ from collections import namedtuple
 __version__ = '0.7'
 pgm = os.path.basename(sys.argv[0].rstrip(os.sep))
 EXTENSIONS = ('xz', 'zst', 'zstd')
+DIGEST_BUFSIZE = 2 ** 18
+DIGESTS_CACHE = 'etcmaint-digests'
+STAGING_DIR = 'etcmaint-staging'
+# Do not cache the digest of a file modified less than RACY_DELAY seconds ago.
+RACY_DELAY = 1
 RW_ACCESS = stat.S_IWUSR | stat.S_IRUSR
 FIRST_COMMIT_MSG = 'First etcmaint commit'
 CHERRY_PICK_COMMIT_MSG = ('Files updated from new packages versions and'
@@ -29,12 +35,17 @@ GIT_USER_CONFIG = ['-c', 'user.email="etcmaint email"',
 EXCLUDE_FILES = 'passwd, group, mtab, udev/hwdb.bin'
 EXCLUDE_PKGS = ''
 EXCLUDE_PREFIXES = 'ca-certificates, ssl/certs'
+# The names of the EtcMaint 'cmd_*' methods without the prefix, sorted.
+COMMANDS = ('create', 'diff', 'sync', 'update')
+# The valid arguments of the 'help' command.
+HELP_CHOICES = ('help',) + COMMANDS
 ETCMAINT_BRANCHES = ['etc', 'etc-tmp', 'master', 'master-tmp', 'timestamps',
                      'timestamps-tmp']
 EMPTY_CHERRY_PICK_MSG = """An empty commit.
 This may happen when all the changes cherry-picked from the 'etc' branch
 have already been included in the 'master' branch as user changes."""
 
+PACMAN_CONF = '/etc/pacman.conf'
 # The subdirectory of '--root-dir'.
 ROOT_SUBDIR = 'etc'
 
@@ -42,14 +53,24 @@ RE_CACHEDIR = r'^\s*\#?\s*CacheDir\s*=\s*(?P<CacheDir>.*(\w|/))\s*$' \
               r'# CacheDir = possibly white space separated pathname'
 re_cachedir = re.compile(RE_CACHEDIR, re.VERBOSE | re.MULTILINE)
 
+re_validext = re.compile(r'.*\.pkg\.tar\.(%s)' % '|'.join(EXTENSIONS))
+# "Version tags may not include hyphens!" quoting from
+# https://wiki.archlinux.org/index.php/Arch_package_guidelines
+# The package name is followed by the version, release and architecture.
+re_pkgname = re.compile(r'(?P<name>.*)-[^-]*-[^-]*-[^-]*', re.DOTALL)
+
 class EmtError(Exception): pass
 
 def warn(msg):
     print('*** warning:', msg, file=sys.stderr)
 
-def run_cmd(cmd, error='', ignore_failure=False):
-    proc = subprocess.run(cmd, universal_newlines=True,
+def run_cmd(cmd, error='', ignore_failure=False, input=None):
+    # 'input' is bytes when it holds path names encoded with os.fsencode().
+    binary = isinstance(input, bytes)
+    proc = subprocess.run(cmd, input=input, universal_newlines=not binary,
                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if binary:
+        proc.stdout = os.fsdecode(proc.stdout)
     if proc.returncode != 0 and not ignore_failure:
         err_list = []
         if error:
@@ -59,35 +80,87 @@ def run_cmd(cmd, error='', ignore_failure=False):
         raise EmtError('\n'.join(err_list))
     return proc
 
+def blob_header(size):
+    return b'blob %d\0' % size
+
+def blob_digest(f, size=None):
+    """Return the git object name of the content of the binary file 'f'.
+
+    This is the SHA-1 digest of the content prefixed with the header of a git
+    blob so that it may be compared with the object names of the files
+    tracked in the repository. The file is streamed through the hash so that
+    it is never read in memory as a whole. 'size' is the size of the file
+    when it is already known.
+    """
+    if size is None:
+        size = os.fstat(f.fileno()).st_size
+    header = blob_header(size)
+    if hasattr(hashlib, 'file_digest'):
+        return hashlib.file_digest(f, lambda: hashlib.sha1(header)).digest()
+
+    # Python < 3.11.
+    h = hashlib.sha1(header)
+    buf = bytearray(DIGEST_BUFSIZE)
+    view = memoryview(buf)
+    while True:
+        size = f.readinto(buf)
+        if not size:
+            break
+        h.update(view[:size])
+    return h.digest()
+
 def list_rpaths(rootdir, subdir, suffixes=None, prefixes=None):
-    """List of the relative paths of the files in rootdir/subdir.
+    """Generate the relative paths of the files in rootdir/subdir.
 
     Exclude file names that are a match for one of the suffixes in
     'suffixes' and file names that are a match for one of the prefixes in
     'prefixes'.
     """
 
-    flist = []
-    suffixes_len = len(suffixes) if suffixes is not None else 0
-    prefixes_len = len(prefixes) if prefixes is not None else 0
-    with change_cwd(os.path.join(rootdir, subdir)):
-        for root, dirs, files in os.walk('.'):
-            for fname in files:
-                rpath = os.path.normpath(os.path.join(root, fname))
-                # Exclude files ending with one of the suffixes.
-                if suffixes_len:
-                    if (len(list(itertools.takewhile(lambda x: not x or
-                            not rpath.endswith(x), suffixes))) !=
-                                suffixes_len):
-                        continue
-                # Exclude files starting with one of the prefixes.
-                if prefixes_len:
-                    if (len(list(itertools.takewhile(lambda x: not x or
-                            not rpath.startswith(x), prefixes))) !=
-                                prefixes_len):
-                        continue
-                flist.append(os.path.join(subdir, rpath))
-    return flist
+    def scan(path, rdir):
+        # Follow the os.walk() semantics: directories that cannot be listed are
+        # ignored and symbolic links to directories are neither followed nor
+        # listed.
+        try:
+            it = os.scandir(path)
+        except OSError:
+            return
+        with it:
+            for entry in it:
+                rpath = rdir + entry.name
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    if not entry.is_symlink():
+                        yield from scan(entry.path, rpath + os.sep)
+                    continue
+
+                # Exclude files ending with one of the suffixes and files
+                # starting with one of the prefixes.
+                if rpath.endswith(suffixes) or rpath.startswith(prefixes):
+                    continue
+                yield prefix + rpath
+
+    prefix = subdir + os.sep
+    # str.endswith() and str.startswith() return False with an empty tuple.
+    suffixes = tuple(x for x in suffixes if x) if suffixes else ()
+    prefixes = tuple(x for x in prefixes if x) if prefixes else ()
+    return scan(os.path.join(rootdir, subdir), '')
+
+# 'st_mtime_ns' is part of the key so that a change to the file is seen.
+@functools.lru_cache(maxsize=1)
+def pacman_cachedir(path, st_mtime_ns):
+    """Return the CacheDir setting of pacman.conf or None."""
+    with open(path) as f:
+        for line in f:
+            if 'CacheDir' not in line:
+                continue
+            matchobj = re_cachedir.match(line)
+            if matchobj:
+                return matchobj.group('CacheDir')
+    return None
 
 def repository_dir():
     xdg_data_home = os.environ.get('XDG_DATA_HOME')
@@ -103,25 +176,90 @@ def repository_dir():
         raise EmtError('etcmaint requires a controlling terminal') from None
     return os.path.expanduser('~%s/.local/share/etcmaint' % logname)
 
+def make_parent_dirs(rpaths, basedir):
+    """Create the missing parent directories of 'rpaths' in 'basedir'."""
+    for dirname in sorted(set(os.path.dirname(rpath) for rpath in rpaths)):
+        if dirname:
+            os.makedirs(os.path.join(basedir, dirname), exist_ok=True)
+
+def copy_content(src, dst):
+    """Copy the content of the regular file 'src' to 'dst'.
+
+    With os.copy_file_range() the data is copied by the kernel, possibly as a
+    reflink, without going through user space. Fall back to a plain copy
+    when this is not supported.
+    """
+    if not hasattr(os, 'copy_file_range'):
+        # Python < 3.8 or not Linux.
+        shutil.copyfile(src, dst)
+        return
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        infd = fsrc.fileno()
+        outfd = fdst.fileno()
+        copied = 0
+        try:
+            while True:
+                size = os.copy_file_range(infd, outfd, 2 ** 30)
+                if not size:
+                    break
+                copied += size
+        except OSError as e:
+            # Not supported by the kernel, by the file systems or on these
+            # files.
+            if e.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                               errno.EOPNOTSUPP, errno.EPERM,
+                               errno.ETXTBSY, errno.EBADF):
+                raise
+        else:
+            # Some file systems (FUSE, overlayfs, CIFS, procfs, ...) return 0
+            # for a file that is not empty.
+            if copied or os.fstat(infd).st_size == 0:
+                return
+        fsrc.seek(0)
+        fdst.seek(0)
+        fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst)
+
 def copy_file(rpath, rootdir, repodir, repo_file=None):
     """Copy a file on 'rootdir' to the repository.
 
-    'rpath' is the relative path to 'rootdir'.
+    'rpath' is the relative path to 'rootdir'. The parent directory of the
+    file in the repository must exist, see make_parent_dirs().
     """
 
     if repo_file is None:
         repo_file = os.path.join(repodir, rpath)
-    dirname = os.path.dirname(repo_file)
-    if dirname and not os.path.isdir(dirname):
-        os.makedirs(dirname)
     etc_file = os.path.join(rootdir, rpath)
     # Remove destination if source is a symlink or if destination is a symlink
     # (in the last case, source would be copied to the file pointed by
     # destination instead of having the symlink itself being copied).
-    if os.path.lexists(repo_file) and (os.path.islink(etc_file) or
+    etc_islink = os.path.islink(etc_file)
+    if os.path.lexists(repo_file) and (etc_islink or
                                        os.path.islink(repo_file)):
         os.remove(repo_file)
-    shutil.copy2(etc_file, repo_file, follow_symlinks=False)
+    if etc_islink:
+        shutil.copy2(etc_file, repo_file, follow_symlinks=False)
+    else:
+        copy_content(etc_file, repo_file)
+        shutil.copystat(etc_file, repo_file)
+
+def copy_files(rpaths, rootdir, repodir):
+    """Copy concurrently files on 'rootdir' to the repository.
+
+    The parent directories are created first, so the copies made by the
+    threads are independent.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    make_parent_dirs(rpaths, repodir)
+    if len(rpaths) == 1:
+        copy_file(rpaths[0], rootdir, repodir)
+        return
+    with ThreadPoolExecutor() as executor:
+        for _ in executor.map(lambda rpath: copy_file(rpath, rootdir, repodir),
+                              rpaths):
+            pass
 
 @contextlib.contextmanager
 def change_cwd(path):
@@ -147,11 +285,45 @@ def threadsafe_makedirs():
         os.makedirs = saved_makedirs
 
 @contextlib.contextmanager
-def tarfile_open(name, comptype, mode='r'):
+def tarfile_open(name, comptype, mode='r', xz=None):
+    """Open a tar archive in stream mode.
+
+    'xz' is the path of the xz program used to read xz archives, the lzma
+    module is used instead when it is None.
+    """
     import tarfile
 
-    if comptype not in ('zst', 'zstd'):
-        with tarfile.open(name, '%s:%s' % (mode, comptype)) as tar:
+    if mode == 'r' and comptype == 'xz' and xz is not None:
+        # Python's lzma module decompresses on a single thread, the xz
+        # program decompresses multi-block archives on all the cpus.
+        proc = subprocess.Popen([xz, '--decompress', '--stdout',
+                                 '--threads=0', name],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        completed = False
+        try:
+            with tarfile.open(mode='r|', fileobj=proc.stdout) as tar:
+                yield tar
+            # Drain the padding that follows the end of the archive.
+            while proc.stdout.read(io.DEFAULT_BUFFER_SIZE):
+                pass
+            completed = True
+        finally:
+            # xz is killed by SIGPIPE when it is still writing after an
+            # error.
+            proc.stdout.close()
+            stderr = proc.stderr.read()
+            proc.stderr.close()
+            returncode = proc.wait()
+            # When xz fails on a corrupt archive, tarfile fails on the
+            # truncated stream and the xz error is the one reported.
+            if returncode > 0 or (completed and returncode != 0):
+                raise EmtError('cannot decompress %s: %s' %
+                               (name, stderr.decode().strip()))
+    elif comptype not in ('zst', 'zstd'):
+        # Use the stream mode as with z-standard, the archive is decompressed
+        # once sequentially while iterating over its members.
+        with tarfile.open(name, '%s|%s' % (mode, comptype)) as tar:
             yield tar
     else:
         import zstandard as zstd
@@ -170,38 +342,288 @@ def tarfile_open(name, comptype, mode='r'):
                 with tarfile.open(mode="%s|" % mode, fileobj=fobj) as tar:
                     yield tar
 
+@contextlib.contextmanager
+def extract_error(pkg):
+    """Report with an EmtError the failure to extract a package."""
+    try:
+        yield
+    except EmtError:
+        raise
+    except Exception as e:
+        # The exceptions of tarfile, lzma and zstandard on a corrupt
+        # package do not name the package.
+        raise EmtError('cannot extract %s: %s' %
+                       (os.path.basename(pkg), e)) from None
+
+def extract_link_targets(pkg, comptype, xz, repodir, link_targets):
+    """Extract the hard links whose target has not been extracted.
+
+    The package is read again and the content of each target is extracted as
+    a regular file under the name of the first of its hard links, the other
+    hard links are linked to this file.
+    """
+    with tarfile_open(pkg, comptype, xz=xz) as tar:
+        for tinfo in tar:
+            links = link_targets.pop(tinfo.name, None)
+            if links is None:
+                continue
+            tinfo.name = links[0]
+            tinfo.mode |= RW_ACCESS
+            tar.extract(tinfo, repodir)
+            path = os.path.join(repodir, links[0])
+            for fname in links[1:]:
+                link = os.path.join(repodir, fname)
+                if os.path.lexists(link):
+                    os.unlink(link)
+                os.link(path, link)
+            if not link_targets:
+                break
+    if link_targets:
+        target, links = next(iter(link_targets.items()))
+        raise EmtError('cannot find %s, the target of the %s hard link' %
+                       (target, links[0]))
+
+def extract_from(pkg, repodir, exclude_files, xz):
+    """Extract the configuration files of a package into 'repodir'.
+
+    This function is run by a worker process. Return a list of tuples of
+    the extracted configuration file name, its digest, its mode and its
+    size. The digest is computed here while the file content is still in the
+    page cache. 'xz' is the path of the xz program or None.
+    """
+    import tarfile
+
+    # The types of the tar members that are extracted: regular files,
+    # symbolic links and hard links.
+    file_types = frozenset((tarfile.REGTYPE, tarfile.AREGTYPE,
+                            tarfile.CONTTYPE, tarfile.GNUTYPE_SPARSE,
+                            tarfile.SYMTYPE, tarfile.LNKTYPE))
+    comptype = pkg.rsplit('.', 1)[1]
+    extracted = []
+    names = set()
+    # Dictionary {name of the target: list of the names of the hard links}
+    # of the hard links whose target is not extracted.
+    link_targets = {}
+    # Extracting from tarfiles is not thread safe (see msg315067 in bpo
+    # issue https://bugs.python.org/issue23649) and the worker processes may
+    # also create the same directories concurrently.
+    with threadsafe_makedirs(), extract_error(pkg):
+        with tarfile_open(pkg, comptype, xz=xz) as tar:
+            for tinfo in tar:
+                fname = tinfo.name
+                ftype = tinfo.type
+                if (ftype in file_types and fname.startswith(ROOT_SUBDIR)
+                        and fname not in exclude_files):
+                    extracted.append(fname)
+                    names.add(fname)
+
+                    # The archive is read in stream mode and tarfile cannot
+                    # seek back to the content of a target that has not been
+                    # extracted (outside ROOT_SUBDIR or excluded).
+                    if (ftype == tarfile.LNKTYPE and
+                            tinfo.linkname not in names):
+                        link_targets.setdefault(tinfo.linkname,
+                                                []).append(fname)
+                        continue
+
+                    # The Python tarfile implementation fails to create
+                    # symlinks, see also issue bpo-10761.
+                    if ftype == tarfile.SYMTYPE:
+                        abspath = os.path.join(repodir, fname)
+                        try:
+                            if os.path.lexists(abspath):
+                                os.unlink(abspath)
+                        except OSError as err:
+                            warn(err)
+                    else:
+                        # Ensure that the file can be overwritten on a next
+                        # 'update' command, tarfile sets this mode when
+                        # extracting the file.
+                        tinfo.mode |= RW_ACCESS
+                    tar.extract(tinfo, repodir)
+
+        if link_targets:
+            extract_link_targets(pkg, comptype, xz, repodir, link_targets)
+
+    for i, fname in enumerate(extracted):
+        new = EtcPath(repodir, fname)
+        digest = new.digest
+        st_mode = new.st_mode
+        # Check the mode set by tarfile, for example a hard link has the mode
+        # of its target.
+        if (not stat.S_ISLNK(st_mode) and
+                st_mode & RW_ACCESS != RW_ACCESS):
+            st_mode |= RW_ACCESS
+            os.chmod(new.path, st_mode)
+        extracted[i] = (fname, digest, st_mode, new.st_size)
+    return extracted
+
+def compute_digests(etc_paths):
+    """Compute concurrently the digests of a sequence of EtcPath instances.
+
+    The files are read and hashed by a pool of threads as hashlib releases
+    the GIL while hashing large data.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    etc_paths = [p for p in etc_paths if p._digest is None]
+    if len(etc_paths) > 1:
+        with ThreadPoolExecutor() as executor:
+            for _ in executor.map(lambda p: p.digest, etc_paths):
+                pass
+
+class DigestsCache():
+    """A persistent cache of the digests of regular files.
+
+    As with the git index, a cached digest is valid as long as the inode
+    number, the size, the modification time and the change time of the file
+    have not changed. The entries that are not used during an etcmaint command
+    are dropped when the cache is saved.
+    """
+
+    VERSION = 2
+
+    def __init__(self, path):
+        import json
+
+        self.path = path
+        self.entries = {}
+        self.used = {}
+        try:
+            with open(path) as f:
+                content = json.load(f)
+            if content['version'] == self.VERSION:
+                self.entries = content['digests']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    @staticmethod
+    def key(st):
+        return [st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns]
+
+    def get(self, path, st):
+        entry = self.entries.get(path)
+        if entry is not None and entry[:-1] == self.key(st):
+            self.used[path] = entry
+            return bytes.fromhex(entry[-1])
+        return None
+
+    def set(self, path, st, digest, start_time):
+        # A file that is modified again within the granularity of the file
+        # system timestamps would keep the same key (the 'racy git' problem).
+        if max(st.st_mtime, st.st_ctime) < start_time - RACY_DELAY:
+            self.used[path] = self.key(st) + [digest.hex()]
+
+    def save(self):
+        if self.used == self.entries:
+            return
+        import json
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': self.VERSION, 'digests': self.used}, f)
+        os.replace(tmp_path, self.path)
+
 class EtcPath():
-    def __init__(self, basedir, rpath):
+    # There is one instance per tracked file of each branch.
+    __slots__ = ('path', 'cache', '_digest', '_st', 'st_mode', 'st_size')
+
+    def __init__(self, basedir, rpath, cache=None):
         assert rpath.startswith(ROOT_SUBDIR)
-        self.path = pathlib.PosixPath(basedir, rpath)
+        self.path = os.path.join(basedir, rpath)
+        self.cache = cache
         self._digest = None
+        self._st = None
+        self.st_mode = None
+        self.st_size = None
+
+    @classmethod
+    def from_digest(cls, basedir, rpath, digest, st_mode, st_size=None):
+        """Return an EtcPath instance whose digest is already known."""
+        path = cls(basedir, rpath)
+        path._digest = digest
+        path.st_mode = st_mode
+        path.st_size = st_size
+        return path
+
+    def lstat(self):
+        """Return the lstat() result or None when the file cannot be stat'ed.
+        """
+        if self._st is None:
+            try:
+                self._st = os.lstat(self.path)
+            except (FileNotFoundError, PermissionError):
+                self._st = False
+            else:
+                self.st_mode = self._st.st_mode
+                self.st_size = self._st.st_size
+        return self._st or None
+
+    def is_readable(self):
+        """Return True when the file exists and its content can be read."""
+        if self._digest is not None:
+            return self._digest != b''
+        st = self.lstat()
+        if st is None:
+            return False
+        if stat.S_ISLNK(st.st_mode):
+            return True
+        try:
+            with open(self.path, 'rb', buffering=0):
+                return True
+        except OSError:
+            return False
 
     @property
     def digest(self):
         if self._digest is None:
-            try:
-                self.st_mode = self.path.lstat().st_mode
-            except (FileNotFoundError, PermissionError):
-                self.st_mode = None
+            st = self.lstat()
+            if st is None:
                 self._digest = b''
             else:
                 try:
-                    if stat.S_ISLNK(self.st_mode):
-                        # The digest is the path to which the symbolic link
-                        # points.
-                        self._digest = os.readlink(self.path)
+                    if stat.S_ISLNK(st.st_mode):
+                        # The digest is computed on the path to which the
+                        # symbolic link points, as git does.
+                        target = os.fsencode(os.readlink(self.path))
+                        self._digest = hashlib.sha1(blob_header(len(target)) +
+                                                    target).digest()
                     else:
-                        h = hashlib.sha1()
-                        with self.path.open('rb') as f:
-                            h.update(f.read())
-                        self._digest = h.digest()
+                        self._digest = self.file_digest(st)
                 except OSError:
                     self._digest = b''
         return self._digest
 
+    def file_digest(self, st):
+        path = self.path
+        if self.cache is not None:
+            digest = self.cache.get(path, st)
+            if digest is not None:
+                return digest
+
+        start_time = time.time()
+        with open(path, 'rb', buffering=0) as f:
+            digest = blob_digest(f, st.st_size)
+        if self.cache is not None:
+            self.cache.set(path, st, digest, start_time)
+        return digest
+
     def __eq__(self, other):
-        if (isinstance(other, EtcPath) and self.digest == other.digest and
-                self.digest != b''):
+        if not isinstance(other, EtcPath):
+            return False
+        # Files whose sizes differ have different digests, do not compute
+        # them.
+        if (self.st_size is not None and other.st_size is not None and
+                self.st_size != other.st_size):
+            return False
+        if self.digest == other.digest and self.digest != b'':
+            # A symbolic link and a regular file may have the same digest.
+            if stat.S_IFMT(self.st_mode) != stat.S_IFMT(other.st_mode):
+                return False
+            # The mode of a symbolic link tracked by git has no permission
+            # bits.
+            if stat.S_ISLNK(self.st_mode):
+                return True
             # Fix issue #15.
             # Upgraded readonly files are reported as updated by the user.
             return ((self.st_mode & stat.S_IXUSR) ==
@@ -217,6 +639,13 @@ class GitRepo():
         self.curbranch = None
         self.initial_branch = None
         self.initialized = False
+        self._branches = None
+        # Dictionary {branch: dictionary returned by tracked_files()}. The
+        # methods that change the index or a branch clear it.
+        self._tracked = {}
+        # The digests cache is only loaded by the commands that compute
+        # digests.
+        self._digests_cache = None
 
         self.git = []
         self.root_not_repo_owner = False
@@ -303,16 +732,24 @@ class GitRepo():
 
     def close(self):
         if self.initialized:
+            # Do not create a file owned by root in the repository.
+            if (not self.root_not_repo_owner and
+                    self._digests_cache is not None):
+                try:
+                    self._digests_cache.save()
+                except OSError as e:
+                    warn('cannot save the digests cache: %s' % e)
+
             branch = 'master'
             if self.initial_branch in self.branches:
                 branch = self.initial_branch
             if not self.get_status():
                 self.checkout(branch)
 
-    def git_cmd(self, cmd):
+    def git_cmd(self, cmd, input=None):
         if type(cmd) == str:
             cmd = cmd.split()
-        proc = run_cmd(self.git + cmd)
+        proc = run_cmd(self.git + cmd, input=input)
         output = proc.stdout.rstrip()
         return output
 
@@ -322,32 +759,84 @@ class GitRepo():
 
     def checkout(self, branch, create=False):
         if create:
+            # The checkout of an existing branch keeps the tracked files
+            # cache, it does not change any branch.
+            self._tracked.clear()
             self.git_cmd('checkout -b %s' % branch)
+            if self._branches is not None and branch in ETCMAINT_BRANCHES:
+                self._branches.append(branch)
         else:
             if branch == self.curbranch:
                 return
             self.git_cmd('checkout %s' % branch)
         self.curbranch = branch
 
+    def create_branches(self, branches):
+        """Create branches without checking them out.
+
+        'branches' is a dictionary mapping the name of each new branch to the
+        branch it starts from. The branches are created by a single git
+        command.
+        """
+        commands = ''.join('create refs/heads/%s %s\n' % (branch, start) for
+                           branch, start in branches.items())
+        self._tracked.clear()
+        self.git_cmd('update-ref --stdin', input=commands)
+        if self._branches is not None:
+            self._branches.extend(b for b in branches if
+                                  b in ETCMAINT_BRANCHES)
+
+    def delete_branches(self, branches):
+        self._tracked.clear()
+        self.git_cmd(['branch', '-D'] + list(branches))
+        if self._branches is not None:
+            self._branches = [b for b in self._branches if
+                              b not in branches]
+
     def commit(self, commit_msg):
+        self._tracked.clear()
         self.git_cmd(GIT_USER_CONFIG + ['commit', '-m', commit_msg])
 
+    # The paths are written to the standard input of git in add() and
+    # remove(), so the length of the command line is not an issue. They are
+    # encoded as in the command line, with os.fsencode().
+    def add(self, rpaths):
+        """Add files to the index.
+
+        As with 'git add', a file removed from the working tree is removed
+        from the index (--remove) and a file replaced by a directory or the
+        reverse is replaced in the index (--replace).
+        """
+        self._tracked.clear()
+        self.git_cmd(['update-index', '--add', '--remove', '--replace', '-z',
+                      '--stdin'],
+                     input=b'\0'.join(os.fsencode(p) for p in rpaths))
+
+    def remove(self, rpaths):
+        """Remove files from the index and from the working tree."""
+        self._tracked.clear()
+        self.git_cmd(['--literal-pathspecs', 'rm', '--quiet',
+                      '--pathspec-from-file=-', '--pathspec-file-nul'],
+                     input=b'\0'.join(os.fsencode(p) for p in rpaths))
+
     def add_files(self, files, commit_msg):
         """Add and commit a list of files.
 
         'files' is a dictionary mapping filename to the file content that must
         be written before the commit.
         """
-        paths = []
         for rpath in files:
             path = os.path.join(self.repodir, rpath)
-            paths.append(path)
             with open(path, 'w') as f:
                 f.write(files[rpath])
-        if paths:
-            self.git_cmd(['add'] + paths)
+        if files:
+            self.add(files)
             self.commit(commit_msg)
 
+    def merge(self, branch):
+        self._tracked.clear()
+        self.git_cmd('merge %s' % branch)
+
     def cherry_pick(self, sha):
         # --keep-redundant-commits:
         # If a commit being cherry picked duplicates a commit already in the
@@ -355,24 +844,40 @@ class GitRepo():
         # commits cause cherry-pick to stop so the user can examine the
         # commit. This option overrides that behavior and creates an empty
         # commit object.
+        self._tracked.clear()
         return run_cmd(self.git + GIT_USER_CONFIG +
                     ['cherry-pick', '-x', '--keep-redundant-commits',
                      sha], ignore_failure=True)
 
     def tracked_files(self, branch):
-        """A dictionary of the tracked files in this branch."""
+        """A dictionary of the tracked files in this branch.
+
+        The digests of the EtcPath instances are the object names of the git
+        blobs, so the files are neither read nor checked out. The dictionary
+        is cached until the index or a branch is changed by a GitRepo method
+        and must not be modified by the caller.
+        """
+        d = self._tracked.get(branch)
+        if d is not None:
+            return d
         d = {}
-        ls_tree = self.git_cmd('ls-tree -r --name-only --full-tree %s' %
-                               branch)
-        for rpath in ls_tree.splitlines():
+        # With '-z' the records are terminated by NUL and the path names are
+        # not quoted. '-l' adds the size of the blobs.
+        ls_tree = self.git_cmd('ls-tree -r -l -z --full-tree %s' % branch)
+        for line in ls_tree.split('\0')[:-1]:
+            info, rpath = line.split('\t', 1)
             if rpath == '.gitignore':
                 continue
             if branch.startswith('timestamps'):
-                d[rpath] = pathlib.PosixPath(self.repodir, rpath)
+                d[rpath] = os.path.join(self.repodir, rpath)
             else:
                 if not rpath.startswith(ROOT_SUBDIR):
                     continue
-                d[rpath] = EtcPath(self.repodir, rpath)
+                mode, type, object_name, size = info.split()
+                d[rpath] = EtcPath.from_digest(self.repodir, rpath,
+                                    bytes.fromhex(object_name), int(mode, 8),
+                                    int(size))
+        self._tracked[branch] = d
         return d
 
     def check_fast_forward(self, branch):
@@ -385,10 +890,22 @@ class GitRepo():
             raise EmtError('cannot fast-forward the %s branch, please '
             'run again the update command' % branch)
 
+    @property
+    def digests_cache(self):
+        if self._digests_cache is None:
+            self._digests_cache = DigestsCache(os.path.join(self.repodir,
+                                                '.git', DIGESTS_CACHE))
+        return self._digests_cache
+
     @property
     def branches(self):
-        branches = self.git_cmd("for-each-ref --format=%(refname:short)")
-        return [b for b in branches.splitlines() if b in ETCMAINT_BRANCHES]
+        # The list is maintained by the methods that create or delete
+        # branches once it has been built.
+        if self._branches is None:
+            branches = self.git_cmd("for-each-ref --format=%(refname:short)")
+            self._branches = [b for b in branches.splitlines() if
+                              b in ETCMAINT_BRANCHES]
+        return list(self._branches)
 
 class Commit():
     """A commit to add/update or to remove a list of files."""
@@ -404,13 +921,10 @@ class Commit():
         if not self.rpaths:
             return
         self.repo.checkout(self.branch)
-
-        # Command line length overflow is not expected.
-        # For example on an archlinux box:
-        #   find /etc | wc -c   ->    57722
-        #   getconf ARG_MAX'    ->  2097152
-        cmd = 'add' if self.add else 'rm'
-        self.repo.git_cmd([cmd] + self.rpaths)
+        if self.add:
+            self.repo.add(self.rpaths)
+        else:
+            self.repo.remove(self.rpaths)
         self.repo.commit(self.commit_msg)
 
 class EtcMaint():
@@ -418,6 +932,7 @@ class EtcMaint():
 
     def __init__(self, results):
         self.results = results
+        self._etc_rpaths = None
 
     def init(self):
         self.repodir = repository_dir()
@@ -428,17 +943,13 @@ class EtcMaint():
         self.mode = '[dry-run] ' if self.dry_run else ''
 
         if hasattr(self, 'cache_dir') and self.cache_dir is None:
-            with open('/etc/pacman.conf') as f:
-                for line in f:
-                    matchobj = re_cachedir.match(line)
-                    if matchobj:
-                        self.cache_dir = matchobj.group('CacheDir')
-                        break
-                else:
-                    self.cache_dir = '/var/cache/pacman/pkg/'
-                    print('Cannot get CacheDir from pacman.conf, '
-                          'using the hard coded value %s' %
-                          self.cache_dir)
+            self.cache_dir = pacman_cachedir(PACMAN_CONF,
+                                             os.stat(PACMAN_CONF).st_mtime_ns)
+            if self.cache_dir is None:
+                self.cache_dir = '/var/cache/pacman/pkg/'
+                print('Cannot get CacheDir from pacman.conf, '
+                      'using the hard coded value %s' %
+                      self.cache_dir)
 
         Etc_commits = namedtuple('Etc_commits',
                                  ['added', 'cherry_pick', 'removed'])
@@ -499,8 +1010,8 @@ class EtcMaint():
                 if line.startswith('commit '):
                     sha = line[len('commit '):]
                     diff_tree = self.repo.git_cmd(
-                           'diff-tree --no-commit-id --name-only -r %s' % sha)
-                    rpaths = diff_tree.splitlines()
+                        'diff-tree -z --no-commit-id --name-only -r %s' % sha)
+                    rpaths = diff_tree.split('\0')[:-1]
                     lines = (sorted(rpaths) if rpaths else
                              EMPTY_CHERRY_PICK_MSG.splitlines())
                     self.print('\n'.join((' ' * 4 + l) for l in lines))
@@ -528,10 +1039,8 @@ class EtcMaint():
         self.repo.add_files({'.gitignore': '.swp\n'}, FIRST_COMMIT_MSG)
 
         # Create the etc and timestamps branches.
-        self.repo.checkout('etc', create=True)
-        self.repo.checkout('timestamps', create=True)
+        self.repo.create_branches({'etc': 'master', 'timestamps': 'master'})
 
-        self.repo.checkout('master')
         self.repo.init()
         self.update_repository()
         print('Git repository created at %s' % self.repodir)
@@ -590,10 +1099,10 @@ class EtcMaint():
             self.repo.checkout('etc')
 
         suffixes = ['.pacnew', '.pacsave', '.pacorig']
-        etc_files = list_rpaths(self.root_dir, ROOT_SUBDIR,
-                           suffixes=suffixes, prefixes=self.exclude_prefixes)
-        repo_files = list_rpaths(self.repodir, ROOT_SUBDIR)
-        print('\n'.join(sorted(set(etc_files).difference(repo_files))))
+        etc_files = set(list_rpaths(self.root_dir, ROOT_SUBDIR,
+                           suffixes=suffixes, prefixes=self.exclude_prefixes))
+        etc_files.difference_update(list_rpaths(self.repodir, ROOT_SUBDIR))
+        print('\n'.join(sorted(etc_files)))
 
     def cmd_sync(self):
         """Synchronize /etc with changes made by the previous update command.
@@ -620,23 +1129,19 @@ class EtcMaint():
             self.repo.check_fast_forward(branch)
 
         # Find the cherry-pick in the etc-tmp branch.
-        rev_list = self.repo.git_cmd('rev-list --format=%s etc..etc-tmp')
-        cherry_pick_sha = None
-        for line in rev_list.splitlines():
-            if line.startswith('commit '):
-                sha = line[len('commit '):]
-            elif line == CHERRY_PICK_COMMIT_MSG:
-                cherry_pick_sha =  sha
-                break
-        if cherry_pick_sha is None:
+        cherry_pick_sha = self.repo.git_cmd(['rev-list', '-1',
+                                '--fixed-strings',
+                                '--grep=%s' % CHERRY_PICK_COMMIT_MSG,
+                                'etc..etc-tmp'])
+        if not cherry_pick_sha:
             raise EmtError('cannot find a cherry-pick in the etc-tmp branch')
 
         # Copy the files commited in the cherry-pick to /etc.
         self.repo.checkout('master-tmp')
-        res = self.repo.git_cmd('diff-tree --no-commit-id --name-only -r %s' %
-                                cherry_pick_sha)
+        res = self.repo.git_cmd('diff-tree -z --no-commit-id --name-only -r %s'
+                                % cherry_pick_sha)
         print_header = True
-        for rpath in (f for f in res.splitlines() if
+        for rpath in (f for f in res.split('\0')[:-1] if
                       f not in self.exclude_files):
             etc_file = os.path.join(self.root_dir, rpath)
             if not os.path.lexists(etc_file):
@@ -645,9 +1150,14 @@ class EtcMaint():
             if not self.dry_run:
                 path = os.path.join(self.repodir, rpath)
                 try:
-                    if os.path.islink(path) or os.path.islink(etc_file):
+                    if os.path.islink(path):
                         os.remove(etc_file)
-                    shutil.copyfile(path, etc_file, follow_symlinks=False)
+                        shutil.copyfile(path, etc_file,
+                                        follow_symlinks=False)
+                    else:
+                        if os.path.islink(etc_file):
+                            os.remove(etc_file)
+                        copy_content(path, etc_file)
                 except OSError as e:
                     raise EmtError(e) from None
             if print_header:
@@ -663,14 +1173,15 @@ class EtcMaint():
     def create_tmp_branches(self):
         print('Creating the temporary branches')
         branches = self.repo.branches
-        for branch in ('etc', 'master', 'timestamps'):
-            tmp_branch = '%s-tmp' % branch
-            if tmp_branch in branches:
-                self.repo.checkout('master')
-                self.repo.git_cmd('branch --delete --force %s' % tmp_branch)
+        tmp_branches = {'%s-tmp' % branch: branch for
+                        branch in ('etc', 'master', 'timestamps')}
+        previous = [b for b in tmp_branches if b in branches]
+        if previous:
+            self.repo.checkout('master')
+            self.repo.delete_branches(previous)
+            for tmp_branch in previous:
                 print("Remove the previous unused '%s' branch" % tmp_branch)
-            self.repo.checkout(branch)
-            self.repo.checkout(tmp_branch, create=True)
+        self.repo.create_branches(tmp_branches)
 
     def remove_tmp_branches(self):
         """Delete tmp branches, but merge first if not dry run."""
@@ -679,6 +1190,7 @@ class EtcMaint():
             if self.repo.curbranch in ('master-tmp', 'etc-tmp',
                                        'timestamps-tmp'):
                 self.repo.checkout('master')
+            tmp_branches = []
             for branch in ('master', 'etc', 'timestamps'):
                 tmp_branch = '%s-tmp' % branch
                 if not self.dry_run:
@@ -690,8 +1202,9 @@ class EtcMaint():
                             self.repo.git_cmd('tag -f %s-prev %s' %
                                               (branch, branch))
                     self.repo.checkout(branch)
-                    self.repo.git_cmd('merge %s' % tmp_branch)
-                self.repo.git_cmd('branch -D %s' % tmp_branch)
+                    self.repo.merge(tmp_branch)
+                tmp_branches.append(tmp_branch)
+            self.repo.delete_branches(tmp_branches)
 
     def update_repository(self):
         self.create_tmp_branches()
@@ -725,28 +1238,20 @@ class EtcMaint():
                 assert False, ('cherry picking %s to the master-tmp branch'
                                ' but this file does not exist' % rpath)
 
-        # Use first a temporary branch for the cherry-pick.
-        try:
-            self.repo.checkout('cherry-pick', create=True)
-            proc = self.repo.cherry_pick(cherry_pick_sha)
-            if proc.returncode == 0:
-                # Do a fast-forward merge.
-                self.repo.checkout('master-tmp')
-                self.repo.git_cmd('merge cherry-pick')
-                return True
-            else:
-                conflicts = [x[3:] for x in self.repo.get_status()
-                             if 'U' in x[:2]]
-                if conflicts:
-                    assert os.path.exists(os.path.join(self.repodir,
-                                          '.git', 'CHERRY_PICK_HEAD'))
-                    self.repo.git_cmd('cherry-pick --abort')
-                else:
-                    self.repo.git_cmd('reset --hard HEAD')
-                    raise EmtError(proc.stdout)
-        finally:
-            self.repo.checkout('master-tmp')
-            self.repo.git_cmd('branch -D cherry-pick')
+        # Cherry-pick directly on master-tmp, upon conflicts the cherry-pick
+        # is aborted, restoring master-tmp, and done again below after the
+        # list of conflicts has been printed.
+        proc = self.repo.cherry_pick(cherry_pick_sha)
+        if proc.returncode == 0:
+            return True
+        conflicts = [x[3:] for x in self.repo.get_status() if 'U' in x[:2]]
+        if conflicts:
+            assert os.path.exists(os.path.join(self.repodir, '.git',
+                                               'CHERRY_PICK_HEAD'))
+            self.repo.git_cmd('cherry-pick --abort')
+        else:
+            self.repo.git_cmd('reset --hard HEAD')
+            raise EmtError(proc.stdout)
 
         self.print_commits(suffix='-tmp')
 
@@ -777,66 +1282,80 @@ class EtcMaint():
 
         return False
 
+    def etc_rpaths(self):
+        """Return the set of the relative paths of the /etc files.
+
+        The /etc tree is listed once per command.
+        """
+        if self._etc_rpaths is None:
+            self._etc_rpaths = set(list_rpaths(self.root_dir, ROOT_SUBDIR))
+        return self._etc_rpaths
+
+    def removed_from_etc(self, tracked):
+        """Return the sorted list of the 'tracked' files missing in /etc."""
+        # list_rpaths() does not list the files in the directories that
+        # cannot be read nor the symbolic links to directories.
+        return [rpath for rpath in sorted(tracked.keys() - self.etc_rpaths())
+                if not os.path.lexists(os.path.join(self.root_dir, rpath))]
+
     def git_removed_files(self):
         """Remove files that do not exist in /etc."""
 
         etc_tracked = self.repo.tracked_files('etc-tmp')
-        for rpath in etc_tracked:
-            etc_file = os.path.join(self.root_dir, rpath)
-            if not os.path.lexists(etc_file):
-                self.etc_commits.removed.rpaths.append(rpath)
+        self.etc_commits.removed.rpaths.extend(
+                                    self.removed_from_etc(etc_tracked))
         self.etc_commits.removed.commit()
 
         master_tracked = self.repo.tracked_files('master-tmp')
-        for rpath in master_tracked:
-            etc_file = os.path.join(self.root_dir, rpath)
-            if not os.path.lexists(etc_file):
-                self.master_commits.removed.rpaths.append(rpath)
+        self.master_commits.removed.rpaths.extend(
+                                    self.removed_from_etc(master_tracked))
         self.master_commits.removed.commit()
 
     def git_user_updates(self):
         """Update master-tmp with the user changes."""
 
-        suffixes = ['.pacnew', '.pacsave', '.pacorig']
-        etc_files = {n: EtcPath(self.root_dir, n) for n in
-                     list_rpaths(self.root_dir, ROOT_SUBDIR,
-                                 suffixes=suffixes)}
+        suffixes = ('.pacnew', '.pacsave', '.pacorig')
+        cache = self.repo.digests_cache
         etc_tracked = self.repo.tracked_files('etc-tmp')
-
-        # Build the list of etc-tmp files that are different from their
-        # counterpart in /etc.
-        self.repo.checkout('etc-tmp')
-        to_check_in_master = []
-        for rpath in etc_files:
-            if rpath in etc_tracked:
-                # Issue #16. Do not add an /etc file that has been made not
-                # readable after a pacman upgrade.
-                if (etc_files[rpath].digest != b'' and
-                        etc_files[rpath] != etc_tracked[rpath]):
-                    to_check_in_master.append(rpath)
-
         master_tracked = self.repo.tracked_files('master-tmp')
+        # Only the /etc files tracked in one of the branches are compared.
+        etc_files = {rpath: EtcPath(self.root_dir, rpath, cache) for rpath in
+                     self.etc_rpaths() & (etc_tracked.keys() |
+                                          master_tracked.keys())
+                     if not rpath.endswith(suffixes)}
+        # The digest of an /etc file whose size differs from the size of the
+        # tracked file it is compared with is not needed.
+        compute_digests(etc_file for rpath, etc_file in etc_files.items() if
+                        etc_file.lstat() is not None and
+                        etc_file.st_size == (master_tracked.get(rpath) or
+                                             etc_tracked[rpath]).st_size)
 
         # Build the list of master-tmp files:
         #   * To add when the file does not exist in master-tmp and its
         #     counterpart in etc-tmp is different from the /etc file.
         #   * To update when the file exists in master-tmp and is different
         #     from the /etc file.
-        for rpath in to_check_in_master:
-            if rpath not in master_tracked:
-                self.master_commits.user_updated.rpaths.append(rpath)
-        self.repo.checkout('master-tmp')
-        for rpath in etc_files:
-            if (rpath in master_tracked and rpath not in
-                    self.master_commits.added.rpaths):
-                if etc_files[rpath].digest == b'':
-                    warn('cannot read %s' % etc_files[rpath].path)
-                elif etc_files[rpath] != master_tracked[rpath]:
-                    self.master_commits.user_updated.rpaths.append(rpath)
-
-        for rpath in self.master_commits.user_updated.rpaths:
-            copy_file(rpath, self.root_dir, self.repodir)
-        self.master_commits.user_updated.commit()
+        added = set(self.master_commits.added.rpaths)
+        user_updated = self.master_commits.user_updated.rpaths
+        for rpath in sorted(etc_files):
+            etc_file = etc_files[rpath]
+            if rpath in master_tracked:
+                if rpath in added:
+                    continue
+                if not etc_file.is_readable():
+                    warn('cannot read %s' % etc_file.path)
+                elif etc_file != master_tracked[rpath]:
+                    user_updated.append(rpath)
+            # Issue #16. Do not add an /etc file that has been made not
+            # readable after a pacman upgrade.
+            elif etc_file.is_readable() and etc_file != etc_tracked[rpath]:
+                user_updated.append(rpath)
+
+        if self.master_commits.user_updated.rpaths:
+            self.repo.checkout('master-tmp')
+            copy_files(self.master_commits.user_updated.rpaths, self.root_dir,
+                       self.repodir)
+            self.master_commits.user_updated.commit()
 
     def git_upgraded_pkgs(self):
         """Update the repository with installed or upgraded packages."""
@@ -849,10 +1368,6 @@ class EtcMaint():
             self.etc_commits.cherry_pick.commit()
             cherry_pick_sha = self.repo.git_cmd('rev-list -1 HEAD --')
 
-        # Clean the working area of the files that are not under version
-        # control.
-        self.repo.git_cmd('clean -d -x -f')
-
         # Update the master-tmp branch with new files.
         if self.master_commits.added.rpaths:
             self.repo.checkout('master-tmp')
@@ -861,151 +1376,159 @@ class EtcMaint():
                 if os.path.lexists(repo_file):
                     warn('adding %s to the master-tmp branch but this file'
                          ' already exists' % rpath)
-                copy_file(rpath, self.root_dir, self.repodir,
-                          repo_file=repo_file)
+            copy_files(self.master_commits.added.rpaths, self.root_dir,
+                       self.repodir)
             self.master_commits.added.commit()
 
         return cherry_pick_sha
 
-    def list_new_packages(self, cache_dir):
-        """Build the list of new package files."""
-        import re
-
-        def newer_exists_in(packages, name, st_mtime, read_content=True):
-            if name in packages:
-                if read_content:
-                    # A 'tracked' timestamps file.
-                    with packages[name].open() as f:
-                        timestamp = f.read()
-                else:
-                    # A 'new_packages' file.
-                    timestamp = packages[name].stat().st_mtime
-                return float(st_mtime) <= float(timestamp)
-            return False
+    def scan_packages(self, cache_dir, recurse):
+        """Return the newest package files of 'cache_dir'.
 
-        re_validext = re.compile(r'.*\.pkg\.tar\.(%s)' % '|'.join(EXTENSIONS))
-        exclude_pkgs_len = len(self.exclude_pkgs)
+        Return a dictionary {package name: (st_mtime, path of pacman file)}.
+        This method does not use the git repository.
+        """
+        exclude_pkgs = tuple(x for x in self.exclude_pkgs if x)
         excluded = []
-        # 'timestamps' and 'tracked:'
-        # Dictionary {package name: PosixPath with timestamp as content}
-        timestamps = {}
-        tracked = self.repo.tracked_files('timestamps-tmp')
-        # Dictionary {package name: PosixPath of pacman file}
-        new_pkgs = {}
-        self.repo.checkout('timestamps-tmp')
+        packages = {}
+        dirs = [cache_dir]
+        while dirs:
+            try:
+                it = os.scandir(dirs.pop())
+            except OSError:
+                continue
+            with it:
+                for direntry in it:
+                    if direntry.is_dir():
+                        if recurse and not direntry.is_symlink():
+                            dirs.append(direntry.path)
+                        continue
+                    if not direntry.is_file():
+                        continue
 
-        for root, *remain in os.walk(cache_dir):
-            # scandir() started supporting the context manager protocol in
-            # Python 3.6 (see issue bpo-25994) so we cannot use a context
-            # manager here and must delete 'it' when not used anymore so that
-            # the scandir() file descriptor is explicitly closed by Python.
-            it = os.scandir(root)
-            for direntry in it:
-                if not direntry.is_file():
-                    continue
+                    fullname = direntry.name
+                    if not re_validext.match(fullname):
+                        continue
 
-                fullname = direntry.name
-                if not re_validext.match(fullname):
-                    continue
+                    matchobj = re_pkgname.fullmatch(fullname)
+                    if matchobj is None:
+                        warn('ignoring incorrect package name: %s' % fullname)
+                        continue
+                    name = matchobj.group('name')
 
-                # "Version tags may not include hyphens!" quoting from
-                # https://wiki.archlinux.org/index.php/Arch_package_guidelines
-                name, *remain = fullname.rsplit('-', maxsplit=3)
-                if len(remain) != 3:
-                    warn('ignoring incorrect package name: %s' % fullname)
-                    continue
+                    st_mtime = direntry.stat().st_mtime
+                    if name in packages and st_mtime <= packages[name][0]:
+                        continue
 
-                st_mtime = direntry.stat().st_mtime
-                if (newer_exists_in(tracked, name, st_mtime) or
-                        newer_exists_in(new_pkgs, name, st_mtime, False)):
-                    continue
+                    # Exclude packages.
+                    if name in excluded or name.startswith(exclude_pkgs):
+                        if name not in excluded:
+                            excluded.append(name)
+                        continue
 
-                # Exclude packages.
-                if (name in excluded or
-                        len(list(itertools.takewhile(lambda x: not x or
-                            not name.startswith(x),
-                            self.exclude_pkgs))) != exclude_pkgs_len):
-                    if name not in excluded:
-                        excluded.append(name)
-                    continue
+                    packages[name] = (st_mtime, direntry.path)
+        return packages
 
-                timestamps[name] = str(st_mtime)
-                new_pkgs[name] = pathlib.PosixPath(direntry.path)
-            del it
-            # Look the full cache_dir tree only when scanning the 'aur-dir'
-            # directory.
-            if cache_dir != self.aur_dir:
-                break
+    def list_new_packages(self):
+        """Build the lists of new package files.
+
+        Return a list of the new package files of 'cache_dir' and, when
+        'aur_dir' is set, a list of the new package files of 'aur_dir'.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        def newer_exists_in(tracked, name, st_mtime):
+            if name in tracked:
+                with open(tracked[name]) as f:
+                    timestamp = f.read()
+                return float(st_mtime) <= float(timestamp)
+            return False
+
+        # Look the full tree only when scanning the 'aur-dir' directory.
+        dirs = [(self.cache_dir, False)]
+        if self.aur_dir is not None:
+            dirs.append((self.aur_dir, True))
+        # The directory trees are scanned concurrently, the git repository
+        # is only updated once both scans are done.
+        with ThreadPoolExecutor(max_workers=len(dirs)) as executor:
+            scanned = list(executor.map(lambda d: self.scan_packages(*d),
+                                        dirs))
+
+        # Dictionary {package name: path of a file with timestamp as content}
+        tracked = self.repo.tracked_files('timestamps-tmp')
+        self.repo.checkout('timestamps-tmp')
+        # Dictionary {package name: (st_mtime, path of pacman file, index of
+        # the scanned directory)}
+        new_pkgs = {}
+        for idx, packages in enumerate(scanned):
+            for name, (st_mtime, path) in packages.items():
+                if (newer_exists_in(tracked, name, st_mtime) or
+                        (name in new_pkgs and st_mtime <= new_pkgs[name][0])):
+                    continue
+                new_pkgs[name] = (st_mtime, path, idx)
 
         # Commit the new timestamps.
-        if timestamps:
+        if new_pkgs:
             # Add files to the timestamps-tmp branch whose name are the
             # package name and whose content are the modification time.
+            timestamps = {name: str(st_mtime) for
+                          name, (st_mtime, path, idx) in new_pkgs.items()}
             self.repo.add_files(timestamps,
                                 'Add the timestamps of the new packages')
-            self.new_packages = list(pkg.name for pkg in new_pkgs.values())
+            self.new_packages = list(os.path.basename(path) for
+                                     st_mtime, path, idx in new_pkgs.values())
+
+        new_files = [[] for d in dirs]
+        for st_mtime, path, idx in new_pkgs.values():
+            new_files[idx].append(path)
+        return new_files
 
-        return new_pkgs.values()
+    def extract(self, packages, tracked, staging_dir):
+        """ Extract configuration files from packages into 'staging_dir'.
 
-    def extract(self, packages, tracked):
-        """ Extract configuration files from packages.
+        Return a dictionary mapping extracted configuration file names to a
+        tuple of the EtcPath instances of the 'original' file before the
+        extraction and of the 'new' extracted file.
 
-        Return a dictionary mapping extracted configuration file names to the
-        EtcPath instance of the 'original' file before the extraction.
+        The 'original' files are the files tracked in the etc-tmp branch that
+        are listed in 'tracked'.
         """
-        # Lazy imports in a thread are actively discouraged,
-        # see bpo issue 39430.
-        # Do the import here first before starting the threads.
+        # Do the imports here first before starting the worker processes.
         import tarfile
         import zstandard
-        from concurrent.futures import ThreadPoolExecutor
-
-        def extract_from(pkg):
-            with tarfile_open(str(pkg), pkg.suffix[1:]) as tar:
-                for tinfo in tar:
-                    fname = tinfo.name
-                    if (fname.startswith(ROOT_SUBDIR) and
-                            (tinfo.isfile() or tinfo.issym() or tinfo.islnk())
-                            and fname not in self.exclude_files):
-                        path = EtcPath(self.repodir, tinfo.name)
-                        # Remember the sha1 of the existing file, if it
-                        # exists, before extracting it from the tarball
-                        # (EtcPath.digest is lazily evaluated).
-                        not_used = path.digest
-                        extracted[tinfo.name] = path
-
-                        # The Python tarfile implementation fails to create
-                        # symlinks, see also issue bpo-10761.
-                        if tinfo.issym():
-                            abspath = os.path.join(self.repodir, tinfo.name)
-                            try:
-                                if os.path.lexists(abspath):
-                                    os.unlink(abspath)
-                            except OSError as err:
-                                warn(err)
-                        tar.extract(tinfo, self.repodir)
-            print(pkg.name)
+        from concurrent.futures import ProcessPoolExecutor, as_completed
 
         extracted = {}
-        max_workers = len(os.sched_getaffinity(0)) or 4
-        # Extracting from tarfiles is not thread safe (see msg315067 in bpo
-        # issue https://bugs.python.org/issue23649).
-        with threadsafe_makedirs():
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                futures = [executor.submit(extract_from, pkg) for
-                           pkg in packages]
-        for f in futures:
-            exc = f.exception()
-            if exc is not None:
-                raise exc
-        for rpath in extracted:
-            if rpath not in tracked:
-                # Ensure that the file can be overwritten on a next
-                # 'update' command.
-                path = os.path.join(self.repodir, rpath)
-                mode = os.lstat(path).st_mode
-                if mode & RW_ACCESS != RW_ACCESS:
-                    os.chmod(path, mode | RW_ACCESS)
+        packages = list(packages)
+        if not packages:
+            return extracted
+
+        # Decompression and the parsing of the tar headers are done in
+        # parallel by worker processes.
+        max_workers = min(len(packages), len(os.sched_getaffinity(0)) or 4)
+        # Search PATH once instead of once per package.
+        xz = shutil.which('xz')
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(extract_from, pkg, staging_dir,
+                                       self.exclude_files, xz) for
+                       pkg in packages]
+            # Fail as soon as any package fails and cancel the pending ones.
+            for f in as_completed(futures):
+                exc = f.exception()
+                if exc is not None:
+                    for other in futures:
+                        other.cancel()
+                    raise exc
+        for pkg, f in zip(packages, futures):
+            for rpath, digest, st_mode, st_size in f.result():
+                original = tracked.get(rpath)
+                if original is None:
+                    original = EtcPath.from_digest(self.repodir, rpath, b'',
+                                                   None)
+                new = EtcPath.from_digest(staging_dir, rpath, digest,
+                                          st_mode, st_size)
+                extracted[rpath] = (original, new)
+            print(os.path.basename(pkg))
         return extracted
 
     def extract_from_cachedir(self):
@@ -1035,29 +1558,60 @@ class EtcMaint():
         # etc-tmp branch.
         master_tracked = self.repo.tracked_files('master-tmp')
         etc_tracked = self.repo.tracked_files('etc-tmp')
-        packages = self.list_new_packages(self.cache_dir)
+        new_files = self.list_new_packages()
         print('Extracting configuration files from %d new package files' %
-              len(packages), end='')
+              len(new_files[0]), end='')
         if self.aur_dir is not None:
-            aur_packages = self.list_new_packages(self.aur_dir)
-            print(' and %d new AUR package files' % len(aur_packages))
-            packages = itertools.chain(packages, aur_packages)
+            print(' and %d new AUR package files' % len(new_files[1]))
         else:
             print()
-        self.repo.checkout('etc-tmp')
-        original_files = self.extract(packages, etc_tracked)
+        packages = list(itertools.chain.from_iterable(new_files))
+        # The files are extracted out of the working tree and only the files
+        # that are committed to the etc-tmp branch are moved there.
+        staging_dir = os.path.join(self.repodir, '.git', STAGING_DIR)
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        os.mkdir(staging_dir)
+        try:
+            extracted = self.extract(packages, etc_tracked, staging_dir)
+            self.compare_extracted(extracted, etc_tracked, master_tracked)
 
-        for rpath in original_files:
-            new = EtcPath(self.repodir, rpath)
-            current = EtcPath(self.root_dir, rpath)
-            if current.digest == b'':
+            rpaths = (self.etc_commits.added.rpaths +
+                      self.etc_commits.cherry_pick.rpaths)
+            if rpaths:
+                self.repo.checkout('etc-tmp')
+                make_parent_dirs(rpaths, self.repodir)
+                for rpath in rpaths:
+                    os.replace(os.path.join(staging_dir, rpath),
+                               os.path.join(self.repodir, rpath))
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def compare_extracted(self, extracted, etc_tracked, master_tracked):
+        """Apply the pacman logic to the extracted files."""
+
+        cache = self.repo.digests_cache
+        current_files = {rpath: EtcPath(self.root_dir, rpath, cache) for
+                         rpath in extracted}
+        # The digest of an /etc file whose size differs from the size of the
+        # new file is not needed.
+        compute_digests(current for rpath, current in current_files.items()
+                        if current.lstat() is not None and
+                        current.st_size == extracted[rpath][1].st_size)
+
+        etc_added = self.etc_commits.added.rpaths
+        etc_cherry_pick = self.etc_commits.cherry_pick.rpaths
+        master_added = self.master_commits.added.rpaths
+        for rpath, (original, new) in extracted.items():
+            current = current_files[rpath]
+            if not current.is_readable():
                 path = current.path
                 exists = True
                 try:
-                    if not path.exists():
-                        exists = False
+                    os.stat(path)
                 except PermissionError:
                     pass
+                except OSError:
+                    exists = False
                 if not exists:
                     # Do not warn on 'create' subcommand to avoid the noise of
                     # all the /etc files removed after packages removal while
@@ -1071,19 +1625,19 @@ class EtcMaint():
             # A new package has been installed.
             if rpath not in etc_tracked:
                 # Add the file to the etc-tmp branch.
-                self.etc_commits.added.rpaths.append(rpath)
+                etc_added.append(rpath)
                 if new != current:
                     # Case 6.
                     # Add the file name to the list of files to add to the
                     # master-tmp branch (from /etc).
-                    self.master_commits.added.rpaths.append(rpath)
+                    master_added.append(rpath)
             # A package upgrade.
             else:
                 if new == current:
-                    if new != original_files[rpath]:
+                    if new != original:
                         # Case 2 and 4.
                         # Stage the file in the etc-tmp branch.
-                        self.etc_commits.added.rpaths.append(rpath)
+                        etc_added.append(rpath)
                         if rpath in master_tracked:
                             warn('%s should not exist in the master branch'
                                  % rpath)
@@ -1095,12 +1649,22 @@ class EtcMaint():
                     # A specific commit is used for the configuration files
                     # whose changes must be cherry-picked into the master
                     # branch.
-                    if new != original_files[rpath]:
-                        self.etc_commits.cherry_pick.rpaths.append(rpath)
+                    if new != original:
+                        etc_cherry_pick.append(rpath)
                     else:
                         # Case 3.
                         pass
 
+def split_docstring(func):
+    """Return the first line of the docstring of 'func' and the other lines."""
+    head, _, body = func.__doc__.partition('\n')
+    return head, body
+
+# The first line of the docstring of a command is its short help.
+COMMANDS_DOC = {cmd: split_docstring(getattr(EtcMaint, 'cmd_%s' % cmd)) for
+                cmd in COMMANDS}
+COMMANDS_HELP = {cmd: doc[0] for cmd, doc in COMMANDS_DOC.items()}
+
 def dispatch_help(args):
     """Get help on a command."""
     command = args.subcommand
@@ -1108,12 +1672,11 @@ def dispatch_help(args):
         command = 'help'
     args.parsers[command].print_help()
 
-    cmd_func = getattr(EtcMaint, 'cmd_%s' % command, None)
-    if cmd_func:
-        lines = cmd_func.__doc__.splitlines()
-        print('\n%s\n' % lines[0])
+    if command in COMMANDS_DOC:
+        head, body = COMMANDS_DOC[command]
+        print('\n%s\n' % head)
         paragraph = []
-        for l in dedent('\n'.join(lines[2:])).splitlines():
+        for l in dedent(body).splitlines():
             if l == '':
                 if paragraph:
                     print('\n'.join(wrap(' '.join(paragraph), width=78)))
@@ -1124,11 +1687,86 @@ def dispatch_help(args):
         if paragraph:
             print('\n'.join(wrap(' '.join(paragraph), width=78)))
 
+# Only the successful checks are cached, a failed check raises an exception.
+@functools.lru_cache(maxsize=8)
+def isdir(path):
+    if not os.path.isdir(path):
+        raise argparse.ArgumentTypeError('%s is not a directory' % path)
+    return path
+
+def split_list(value):
+    return [x.strip() for x in value.split(',')]
+
+def split_etc_list(value):
+    prefix = ROOT_SUBDIR + os.sep
+    # A set since the membership of each tar member is tested.
+    return frozenset(prefix + x.strip() for x in value.split(','))
+
+def add_dry_run_option(parser):
+    parser.add_argument('--dry-run', '-n', help='Perform a trial run'
+        ' with no changes made (default: %(default)s)',
+        action='store_true', default=False)
+
+def add_packages_options(parser):
+    parser.add_argument('--cache-dir', help='Set pacman cache'
+        ' directory (override the /etc/pacman.conf setting of the'
+        ' CacheDir option)', type=isdir)
+    parser.add_argument('--aur-dir', help='Set the path of the root '
+        'of the directory tree where to look for built AUR packages',
+        type=isdir)
+    parser.add_argument('--exclude-pkgs', default=EXCLUDE_PKGS,
+        type=split_list,
+        help='A comma separated list of prefix of package names'
+             ' to be ignored (default: "%(default)s")',
+        metavar='PFXS')
+
+def add_exclude_files_option(parser):
+    parser.add_argument('--exclude-files', default=EXCLUDE_FILES,
+        type=split_etc_list, metavar='FILES',
+        help='A comma separated list of /etc path names to be ignored'
+             ' (default: "%(default)s")')
+
+def add_diff_options(parser):
+    parser.add_argument('--exclude-prefixes',
+        default=EXCLUDE_PREFIXES, metavar='PFXS', type=split_list,
+        help='A comma separated list of prefixes of /etc path'
+        ' names to be ignored (default: "%(default)s")')
+    parser.add_argument('--use-etc-tmp',
+        help='Use the etc-tmp branch instead (default: %(default)s)',
+        action='store_true', default=False)
+
+def add_root_dir_option(parser):
+    parser.add_argument('--root-dir', default='/',
+        help='Set the root directory of the etc files, mostly used for'
+        ' testing (default: "%(default)s")', type=isdir)
+
+# The functions adding the options of each command, '--root-dir' is an
+# option of all the commands.
+COMMANDS_OPTIONS = {
+    'create': (add_packages_options, add_exclude_files_option),
+    'diff': (add_diff_options,),
+    'sync': (add_dry_run_option, add_exclude_files_option),
+    'update': (add_dry_run_option, add_packages_options,
+               add_exclude_files_option),
+}
+
+def sniff_subcommand(argv):
+    """Return the commands whose subparser must be built to parse 'argv'."""
+    args = [a for a in argv[1:] if not a.startswith('-')]
+    if args and args[0] == 'help':
+        args = args[1:]
+        # The main parser help lists all the commands.
+        if not args:
+            return COMMANDS
+    if args and args[0] in COMMANDS:
+        return (args[0],)
+    return COMMANDS
+
 def parse_args(argv, namespace):
-    def isdir(path):
-        if not os.path.isdir(path):
-            raise argparse.ArgumentTypeError('%s is not a directory' % path)
-        return path
+    # Do not build the parsers to print the version.
+    if argv[1:] in (['--version'], ['-v']):
+        print('etcmaint %s' % __version__)
+        sys.exit(0)
 
     # Instantiate the main parser.
     main_parser = argparse.ArgumentParser(prog=pgm,
@@ -1142,59 +1780,26 @@ def parse_args(argv, namespace):
     subparsers = main_parser.add_subparsers(title='etcmaint subcommands')
     parsers = { 'help': main_parser }
     parser = subparsers.add_parser('help', add_help=False,
-                                   help=dispatch_help.__doc__.splitlines()[0])
-    parser.add_argument('subcommand', choices=parsers, nargs='?',
+                        help=dispatch_help.__doc__.partition('\n')[0])
+    parser.add_argument('subcommand', choices=HELP_CHOICES, nargs='?',
                         default=None)
-    parser.set_defaults(command='dispatch_help', parsers=parsers)
-
-    # Add the command subparsers.
-    d = dict(inspect.getmembers(EtcMaint, inspect.isfunction))
-    for command in sorted(d):
-        if not command.startswith('cmd_'):
-            continue
-        cmd = command[4:]
-        func = d[command]
-        parser = subparsers.add_parser(cmd, help=func.__doc__.splitlines()[0],
+    parser.set_defaults(command=dispatch_help, parsers=parsers)
+
+    # Add the subparsers of the commands that may be used by 'argv'.
+    for cmd in sniff_subcommand(argv):
+        command = 'cmd_%s' % cmd
+        parser = subparsers.add_parser(cmd, help=COMMANDS_HELP[cmd],
                                        add_help=False)
         parser.set_defaults(command=command)
-        if cmd in ('update', 'sync'):
-            parser.add_argument('--dry-run', '-n', help='Perform a trial run'
-                ' with no changes made (default: %(default)s)',
-                action='store_true', default=False)
-        if cmd in ('create', 'update'):
-            parser.add_argument('--cache-dir', help='Set pacman cache'
-                ' directory (override the /etc/pacman.conf setting of the'
-                ' CacheDir option)', type=isdir)
-            parser.add_argument('--aur-dir', help='Set the path of the root '
-                'of the directory tree where to look for built AUR packages',
-                type=isdir)
-            parser.add_argument('--exclude-pkgs', default=EXCLUDE_PKGS,
-                type=lambda x: list(y.strip() for y in x.split(',')),
-                help='A comma separated list of prefix of package names'
-                     ' to be ignored (default: "%(default)s")',
-                metavar='PFXS')
-        if cmd in ('create', 'update', 'sync'):
-            parser.add_argument('--exclude-files', default=EXCLUDE_FILES,
-                type=lambda x: list(os.path.join(ROOT_SUBDIR, y.strip()) for
-                y in x.split(',')), metavar='FILES',
-                help='A comma separated list of /etc path names to be ignored'
-                     ' (default: "%(default)s")')
-        if cmd == 'diff':
-            parser.add_argument('--exclude-prefixes',
-                default=EXCLUDE_PREFIXES, metavar='PFXS',
-                type=lambda x: list(y.strip() for y in x.split(',')),
-                help='A comma separated list of prefixes of /etc path'
-                ' names to be ignored (default: "%(default)s")')
-            parser.add_argument('--use-etc-tmp',
-                help='Use the etc-tmp branch instead (default: %(default)s)',
-                action='store_true', default=False)
-        parser.add_argument('--root-dir', default='/',
-            help='Set the root directory of the etc files, mostly used for'
-            ' testing (default: "%(default)s")', type=isdir)
+        for add_options in COMMANDS_OPTIONS[cmd]:
+            add_options(parser)
+        add_root_dir_option(parser)
         parsers[cmd] = parser
 
+    # The subparsers set 'command' to the name of the method to run.
+    namespace.command = None
     main_parser.parse_args(argv[1:], namespace=namespace)
-    if not hasattr(namespace, 'command'):
+    if namespace.command is None:
         main_parser.error('a command is required')
 
 def etcmaint(argv):
@@ -1204,9 +1809,8 @@ def etcmaint(argv):
         parse_args(argv, emt)
 
         # Run the command.
-        if emt.command == 'dispatch_help':
-            func = getattr(sys.modules[__name__], 'dispatch_help')
-            func(emt)
+        if emt.command is dispatch_help:
+            dispatch_help(emt)
         else:
             emt.run(emt.command)
     return emt
@@ -1215,8 +1819,7 @@ def main():
     try:
         etcmaint(sys.argv)
     except EmtError as e:
-        print('*** %s: error:' % pgm, e, file=sys.stderr)
-        sys.exit(1)
+        sys.exit('*** %s: error: %s' % (pgm, e))
 
 if __name__ == '__main__':
     main()
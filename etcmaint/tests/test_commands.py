@@ -3,6 +3,7 @@
 import sys
 import os
 import io
+import errno
 import stat
 import tempfile
 import time
@@ -17,7 +18,7 @@ from unittest.mock import patch
 
 from etcmaint.etcmaint import (ETCMAINT_BRANCHES, change_cwd, etcmaint,
                                ROOT_SUBDIR, EtcPath, EmtError, EtcMaint,
-                               tarfile_open)
+                               tarfile_open, COMMANDS, __version__)
 
 EXTENSION = 'zst'
 ROOT_DIR = 'root'
@@ -149,16 +150,30 @@ class Command():
                        dir_path=self.root_dir)
 
     def add_package(self, name, files, or_modes={}, and_modes={},
-                version='1.0', release='1', cache_dir=None, delta_mtime=None):
-        """Add a package."""
+                version='1.0', release='1', cache_dir=None, delta_mtime=None,
+                extension=EXTENSION, hardlinks={}):
+        """Add a package.
+
+        'hardlinks' maps file names in 'files' to the paths, relative to the
+        root of the package, of the hard links to these files. The hard links
+        are added to the package before ROOT_SUBDIR and become the targets of
+        the hard links of the package.
+        """
         cache_dir = self.cache_dir if cache_dir is None else cache_dir
         if not os.path.isdir(cache_dir):
             os.makedirs(cache_dir)
         pkg_name = os.path.join(cache_dir, '%s-%s-%s-%s.pkg.tar.%s' %
-                    (name, version, release, os.uname().machine, EXTENSION))
+                    (name, version, release, os.uname().machine, extension))
         with temp_cwd():
             self.add_files(files, or_modes=or_modes, and_modes=and_modes)
-            with tarfile_open(pkg_name, EXTENSION, mode='w') as tar:
+            with tarfile_open(pkg_name, extension, mode='w') as tar:
+                for fname, path in hardlinks.items():
+                    dirname = os.path.dirname(path)
+                    if not os.path.isdir(dirname):
+                        os.makedirs(dirname)
+                    os.link(os.path.join(ROOT_SUBDIR, fname), path)
+                    if not path.startswith(ROOT_SUBDIR):
+                        tar.add(path)
                 tar.add(ROOT_SUBDIR)
         # Update the package modification and access times.
         if delta_mtime is None:
@@ -272,6 +287,17 @@ class CommandLineTestCase(BaseTestCase):
         self.assertIn('An Arch Linux tool based on git for the maintenance'
                   ' of /etc files.', out)
 
+    def test_cl_version(self):
+        with self.assertRaises(SystemExit):
+            self.run_cmd('--version', with_rootdir=False, clear_stdout=False)
+        self.assertEqual(self.stdout.getvalue(), 'etcmaint %s\n' % __version__)
+
+    def test_cl_commands(self):
+        # Check that COMMANDS lists all the EtcMaint commands.
+        commands = sorted(name[4:] for name in vars(EtcMaint) if
+                          name.startswith('cmd_'))
+        self.assertEqual(commands, list(COMMANDS))
+
     def test_cl_create_help(self):
         self.run_cmd('help', 'create', with_rootdir=False, clear_stdout=False)
         self.assertIn('Create the git repository', self.stdout.getvalue())
@@ -376,6 +402,13 @@ class CommandsTestCase(BaseTestCase):
         self.emt.repo.add_files({os.path.join(ROOT_SUBDIR, fname): content},
                                commit_msg)
 
+    def corrupt_package(self, pkg):
+        # Keep the modification time so that the package is still new.
+        st = os.stat(pkg)
+        with open(pkg, 'wb') as f:
+            f.write(b'not a package')
+        os.utime(pkg, ns=(st.st_atime_ns, st.st_mtime_ns))
+
     def simple_cherry_pick(self):
         content = ['line %d' % n for n in range(5)]
         user_content = content[:]; user_content[0] = 'user line 0'
@@ -521,6 +554,86 @@ class CreateTestCase(CommandsTestCase):
         self.run_cmd('create', '--exclude-files', 'foo, b, bar')
         self.check_results([], ['a', 'bbb'])
 
+    def create_hardlink_packages(self, extension=EXTENSION):
+        # The target of the hard link is outside ROOT_SUBDIR.
+        files = {'a': 'a content'}
+        self.cmd.add_etc_files(files)
+        self.cmd.add_package('package_a', files, extension=extension,
+                             hardlinks={'a': 'usr/a'})
+        # The target of the hard link is excluded.
+        files = {'b': 'b content'}
+        self.cmd.add_etc_files(files)
+        self.cmd.add_package('package_b', files, extension=extension,
+                             hardlinks={'b': os.path.join(ROOT_SUBDIR, 'a0')})
+        self.run_cmd('create', '--exclude-files', 'a0')
+        self.check_results([], ['a', 'b'])
+        self.check_content('etc', 'a', 'a content')
+        self.check_content('etc', 'b', 'b content')
+
+    def test_create_hardlink(self):
+        # Check the extraction of a hard link whose target is not extracted.
+        self.create_hardlink_packages()
+
+    @skipIf(shutil.which('xz') is None, 'xz is not installed')
+    def test_create_hardlink_xz(self):
+        # The xz packages are decompressed by the xz program.
+        self.create_hardlink_packages(extension='xz')
+
+    def test_create_hardlink_xz_lzma(self):
+        # The xz packages are decompressed by the lzma module.
+        with patch('shutil.which', return_value=None):
+            self.create_hardlink_packages(extension='xz')
+
+    def test_create_tracked_files_cache(self):
+        # Check that the tracked files listed after a commit are up to date.
+        self.cmd.add_etc_files({'a': 'content'})
+        self.cmd.add_package('package_a', {'a': 'content'})
+        self.run_cmd('create')
+        self.check_results([], ['a'])
+
+        self.add_repo_file('master', 'b', 'content', 'Add b')
+        self.check_results(['b'], ['a'])
+
+    def test_create_add_removed_and_replaced(self):
+        # Check that GitRepo.add() handles, as 'git add' does, a file
+        # replaced by a directory and a file removed from the working tree.
+        self.cmd.add_etc_files({'a': 'content'})
+        self.cmd.add_package('package_a', {'a': 'content'})
+        self.run_cmd('create')
+        self.add_repo_file('master', 'b', 'content', 'Add b')
+        self.check_results(['b'], ['a'])
+
+        repo = self.emt.repo
+        path = os.path.join(self.emt.repodir, ROOT_SUBDIR, 'b')
+        os.unlink(path)
+        os.mkdir(path)
+        with open(os.path.join(path, 'c'), 'w') as f:
+            f.write('content')
+        repo.add([os.path.join(ROOT_SUBDIR, 'b', 'c')])
+        repo.commit('Replace b with a directory')
+        self.check_results(['b/c'], ['a'])
+
+        os.unlink(os.path.join(path, 'c'))
+        repo.add([os.path.join(ROOT_SUBDIR, 'b', 'c')])
+        repo.commit('Remove b/c')
+        self.check_results([], ['a'])
+
+    def test_create_add_undecodable_name(self):
+        # Check that GitRepo.add() accepts a path name that is not valid
+        # UTF-8.
+        self.cmd.add_etc_files({'a': 'content'})
+        self.cmd.add_package('package_a', {'a': 'content'})
+        self.run_cmd('create')
+        self.add_repo_file('master', 'b', 'content', 'Add b')
+
+        rpath = os.fsdecode(os.path.join(os.fsencode(ROOT_SUBDIR), b'\xff'))
+        with open(os.path.join(self.emt.repodir, rpath), 'w') as f:
+            f.write('content')
+        self.emt.repo.add([rpath])
+        self.emt.repo.commit('Add an undecodable name')
+        self.assertIn('"%s/\\377"' % ROOT_SUBDIR,
+                      self.emt.repo.git_cmd('ls-tree -r --name-only master'))
+
     def test_create_repo_not_empty(self):
         repo_dir = os.path.join(self.tmpdir, REPO_DIR)
         os.makedirs(os.path.join(repo_dir, 'some_dir'))
@@ -718,6 +831,22 @@ class UpdateTestCase(CommandsTestCase):
         self.check_content('etc', 'a', 'package content')
         self.check_content('master', 'a', self.cmd.etc_abspath('b'))
 
+    def test_update_symlink_to_file(self):
+        # A symlink is changed by the user to a file whose content is the
+        # path to which the symlink points.
+        files = {'a': 'content', 'b': SymLink('a', False)}
+        self.cmd.add_etc_files(files)
+        self.cmd.add_package('package', files)
+        self.run_cmd('create')
+        self.check_results([], ['a', 'b'])
+
+        self.cmd.remove_etc_file('b')
+        self.cmd.add_etc_files({'b': 'a'})
+        self.run_cmd('update')
+        self.check_results(['b'], ['a', 'b'])
+        self.check_content('master', 'b', 'a')
+        self.check_is_symlink('etc', 'b')
+
     def test_update_upgrade_symlink(self):
         # Issue #9.
         # 'a' /etc file is changed to a symlink by an upgrade.
@@ -748,6 +877,28 @@ class UpdateTestCase(CommandsTestCase):
         self.check_content('master', 'a', 'new user content')
         self.check_content('etc', 'a', 'content')
 
+    def test_update_digests_cache(self):
+        # Check that the digests of the /etc files are cached and that a
+        # change in a cached file is detected when its size and modification
+        # time are unchanged.
+        self.cmd.add_etc_files({'a': 'content'})
+        self.cmd.add_package('package_a', {'a': 'content'})
+        with patch('etcmaint.etcmaint.RACY_DELAY', -60):
+            self.run_cmd('create')
+            self.check_results([], ['a'])
+            cache_path = os.path.join(self.emt.repodir, '.git',
+                                      'etcmaint-digests')
+            with open(cache_path) as f:
+                self.assertIn(self.cmd.etc_abspath('a'), f.read())
+
+            path = self.cmd.etc_abspath('a')
+            st = os.stat(path)
+            self.cmd.add_etc_files({'a': 'CONTENT'})
+            os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+            self.run_cmd('update')
+        self.check_results(['a'], ['a'])
+        self.check_content('master', 'a', 'CONTENT')
+
     def test_update_user_update_customized(self):
         # File customized by user and updated by user.
         self.cmd.add_etc_files({'a': 'user content'})
@@ -761,6 +912,33 @@ class UpdateTestCase(CommandsTestCase):
         self.run_cmd('update')
         self.check_content('master', 'a', 'new user content')
 
+    def test_update_copy_file_range_zero(self):
+        # Some file systems return 0 with copy_file_range() for a file that
+        # is not empty.
+        with patch('os.copy_file_range', return_value=0,
+                   create=True) as copy_file_range:
+            self.test_update_user_update_customized()
+        self.assertTrue(copy_file_range.called)
+
+    def test_update_copy_file_range_exdev(self):
+        # copy_file_range() fails across file systems on Linux < 5.3.
+        exdev = OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        with patch('os.copy_file_range', create=True,
+                   side_effect=exdev) as copy_file_range:
+            self.test_update_user_update_customized()
+        self.assertTrue(copy_file_range.called)
+
+    def test_update_non_ascii_name(self):
+        # git quotes non ASCII path names unless '-z' is used.
+        self.cmd.add_etc_files({'\xe9t\xe9': 'user content'})
+        self.cmd.add_package('package_a', {'\xe9t\xe9': 'package content'})
+        self.run_cmd('create')
+        self.check_results(['\xe9t\xe9'], ['\xe9t\xe9'])
+
+        self.cmd.add_etc_files({'\xe9t\xe9': 'new user content'})
+        self.run_cmd('update')
+        self.check_content('master', '\xe9t\xe9', 'new user content')
+
     def test_update_user_add(self):
         # 'b' file not from a package, manually added to master and updated by
         # the user.
@@ -861,6 +1039,153 @@ class UpdateTestCase(CommandsTestCase):
         self.check_results([], ['a'])
         self.check_content('etc', 'a', 'new content')
 
+    def update_xz_package(self, corrupt=False):
+        files = {'a': 'initial content'}
+        self.cmd.add_etc_files(files)
+        self.cmd.add_package('package', files, extension='xz')
+        self.run_cmd('create')
+
+        files['a'] = 'new content'
+        self.cmd.add_etc_files(files)
+        pkg = self.cmd.add_package('package', files, release='2',
+                                   extension='xz')
+        if corrupt:
+            self.corrupt_package(pkg)
+            with self.assertRaisesRegex(EmtError,
+                                        'cannot .*package-1.0-2-'):
+                self.run_cmd('update')
+        else:
+            self.run_cmd('update')
+            self.check_results([], ['a'])
+            self.check_content('etc', 'a', 'new content')
+
+    @skipIf(shutil.which('xz') is None, 'xz is not installed')
+    def test_update_xz_package(self):
+        # The xz packages are decompressed by the xz program.
+        self.update_xz_package()
+
+    def test_update_xz_package_lzma(self):
+        # The xz packages are decompressed by the lzma module when the xz
+        # program is not installed.
+        with patch('shutil.which', return_value=None):
+            self.update_xz_package()
+
+    @skipIf(shutil.which('xz') is None, 'xz is not installed')
+    def test_update_corrupt_xz_package(self):
+        self.update_xz_package(corrupt=True)
+
+    def test_update_corrupt_xz_package_lzma(self):
+        with patch('shutil.which', return_value=None):
+            self.update_xz_package(corrupt=True)
+
+    def test_update_staging_dir(self):
+        # The extracted files are moved from the staging directory to the
+        # etc-tmp working tree and the staging directory is removed.
+        files = {'a': 'initial content'}
+        self.cmd.add_etc_files(files)
+        self.cmd.add_package('package', files)
+        self.run_cmd('create')
+
+        files['a'] = 'new content'
+        self.cmd.add_etc_files(files)
+        self.cmd.add_package('package', files, release='2')
+        self.run_cmd('update')
+        self.check_results([], ['a'])
+        self.check_content('etc', 'a', 'new content')
+        self.check_status([])
+        staging_dir = os.path.join(self.emt.repodir, '.git',
+                                   'etcmaint-staging')
+        self.assertFalse(os.path.lexists(staging_dir))
+
+    def create_and_corrupt_upgrade(self):
+        # Upgrade two packages after the create command, the second one is
+        # corrupt.
+        files = {'a': 'initial content', 'b': 'initial content'}
+        self.cmd.add_etc_files(files)
+        self.cmd.add_package('package_a', {'a': files['a']})
+        self.cmd.add_package('package_b', {'b': files['b']})
+        self.run_cmd('create')
+
+        files = {'a': 'new content', 'b': 'new content'}
+        self.cmd.add_etc_files(files)
+        self.cmd.add_package('package_a', {'a': files['a']}, release='2')
+        pkg = self.cmd.add_package('package_b', {'b': files['b']},
+                                   release='2')
+        self.corrupt_package(pkg)
+
+    def update_corrupt_package(self):
+        with self.assertRaisesRegex(EmtError,
+                                    'cannot extract package_b-1.0-2-'):
+            self.run_cmd('update', clear_stdout=False)
+
+    def test_update_extract_failure(self):
+        # Check that the first package that cannot be extracted aborts the
+        # command and that the pending extractions are cancelled.
+        from concurrent.futures import Future, ProcessPoolExecutor
+
+        self.create_and_corrupt_upgrade()
+        submitted = []
+        submit = ProcessPoolExecutor.submit
+        def record_submit(executor, *args, **kwds):
+            future = submit(executor, *args, **kwds)
+            submitted.append(future)
+            return future
+
+        with patch.object(ProcessPoolExecutor, 'submit', autospec=True,
+                          side_effect=record_submit), \
+                patch.object(Future, 'cancel', autospec=True,
+                             side_effect=Future.cancel) as future_cancel:
+            self.update_corrupt_package()
+        self.assertEqual(len(submitted), 2)
+        cancelled = [c.args[0] for c in future_cancel.call_args_list]
+        for future in submitted:
+            self.assertIn(future, cancelled)
+        self.check_output(is_notin='package_a-1.0-2-')
+
+    def test_update_staging_dir_failure(self):
+        # The staging directory is removed when the extraction fails and
+        # the etc-tmp working tree is not modified.
+        self.create_and_corrupt_upgrade()
+        self.update_corrupt_package()
+
+        # self.emt is the EtcMaint instance of the 'create' command.
+        staging_dir = os.path.join(self.emt.repodir, '.git',
+                                   'etcmaint-staging')
+        self.assertFalse(os.path.lexists(staging_dir))
+        self.check_status([])
+        self.check_content('etc-tmp', 'a', 'initial content')
+        self.check_content('etc-tmp', 'b', 'initial content')
+        self.emt.repo.checkout('etc-tmp')
+        for fname in ('a', 'b'):
+            with open(os.path.join(self.emt.repodir, ROOT_SUBDIR,
+                                   fname)) as f:
+                self.assertEqual(f.read(), 'initial content')
+
+    def test_update_previous_tmp_branches(self):
+        # Check that the unused temporary branches of a previous command are
+        # removed and that the list of branches is kept up to date.
+        self.cmd.add_etc_files({'a': 'content'})
+        self.cmd.add_package('package_a', {'a': 'content'})
+        self.run_cmd('create')
+
+        repo = self.emt.repo
+        repo.create_branches({'etc-tmp': 'etc', 'master-tmp': 'master'})
+        self.assertEqual(sorted(repo.branches),
+                ['etc', 'etc-tmp', 'master', 'master-tmp', 'timestamps'])
+        repo.checkout('etc-tmp')
+        repo.add_files({os.path.join(ROOT_SUBDIR, 'z'): 'content'}, 'Add z')
+        repo.checkout('master')
+
+        self.run_cmd('update', clear_stdout=False)
+        self.check_output(is_in="Remove the previous unused 'etc-tmp' branch")
+        self.check_output(
+                    is_in="Remove the previous unused 'master-tmp' branch")
+        self.check_results([], ['a'], ['etc', 'master', 'timestamps'])
+        heads = self.emt.repo.git_cmd(
+                        'for-each-ref --format=%(refname:short) refs/heads')
+        self.assertEqual(sorted(self.emt.repo.branches),
+                         sorted(heads.splitlines()))
+
     def test_update_removed_after_upgrade(self):
         # Issue #8
         # A file is upgraded by a new package version and deleted from /etc
@@ -1109,6 +1434,8 @@ class DiffTestCase(CommandsTestCase):
         self.check_output(is_in='\n'.join(os.path.join(ROOT_SUBDIR, x)
                                for x in ['b', 'c']),
                                is_notin=os.path.join(ROOT_SUBDIR, 'a'))
+        # The diff command does not load the digests cache.
+        self.assertIsNone(self.emt.repo._digests_cache)
 
     def test_diff_exclude_suffixes(self):
         files = {f: 'content of %s' % f for f in ('a', 'b', 'c')}